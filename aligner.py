@@ -5,19 +5,30 @@ MFA Wrapper - обёртка над Montreal Forced Aligner
 
 Оптимизации:
 - align_one вместо align (пропускает corpus setup)
-- ffmpeg для resample (быстрее чем librosa)
+- soxr для resample in-process (без запуска ffmpeg), ffmpeg — fallback
 - --uses_speaker_adaptation false (не нужен для TTS)
 - --no_textgrid_cleanup (экономим время)
 - --beam 100 (увеличен с дефолтного 10 для стабильности)
+- пул долгоживущих MFA процессов (MFA импортируется один раз, а не на каждый запрос)
+- дисковый LRU кэш (16kHz WAV + TextGrid) — повторные запросы не запускают MFA
 """
 
+import importlib.metadata
+import io
 import os
+import re
 import subprocess
 import tempfile
 import time
-from typing import List, Dict, Optional
+from typing import Dict, Optional
 
-import textgrid
+import numpy as np
+import soundfile as sf
+import soxr
+
+from alignment_cache import AlignmentCache
+from mfa_worker import MFAWorkerPool, MFA_WORKERS
+from word_timing import WordTiming
 
 
 # Маппинг языков на MFA модели
@@ -44,9 +55,28 @@ LANGUAGE_MODELS = {
     }
 }
 
+# language -> (acoustic, dictionary), без вложенных dict lookup'ов на каждый запрос
+_MODELS_BY_LANG = {
+    lang: (models["acoustic"], models["dictionary"])
+    for lang, models in LANGUAGE_MODELS.items()
+}
+
+# Версия MFA — часть ключа кэша (метаданные пакета, без импорта самого MFA)
+try:
+    MFA_VERSION = importlib.metadata.version("montreal-forced-aligner")
+except importlib.metadata.PackageNotFoundError:
+    MFA_VERSION = "unknown"
+
 # MFA требует 16kHz 16-bit
 MFA_SAMPLE_RATE = 16000
 
+# Рабочие файлы MFA (WAV, транскрипт, TextGrid) — в tmpfs, если он есть
+SCRATCH_DIR = os.environ.get("MFA_SCRATCH_DIR") or ("/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+# TextGrid (long format): блок tier'а "words" и интервалы внутри него
+_WORDS_RE = re.compile(r'name = "words".*?(?=item \[|\Z)', re.S | re.I)
+_IVAL_RE = re.compile(r'xmin = ([-\d.eE+]+)\s+xmax = ([-\d.eE+]+)\s+text = "((?:[^"]|"")*)"')
+
 
 class MFAAligner:
     """
@@ -54,62 +84,103 @@ class MFAAligner:
     
     Модели загружаются при билде Docker образа.
     PostgreSQL server запускается при старте контейнера.
+    Alignment выполняется в пуле долгоживущих MFA воркеров.
     """
     
-    def __init__(self):
+    def __init__(self, workers: int = MFA_WORKERS):
         self.available_languages = list(LANGUAGE_MODELS.keys())
         self._verify_models()
+        self._pool = MFAWorkerPool(workers)
+        self._cache = AlignmentCache()
+    
+    def close(self):
+        """Останавливает MFA воркеры"""
+        self._pool.close()
+    
+    def __enter__(self) -> "MFAAligner":
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
     
     def _verify_models(self):
         """Проверяем что модели загружены"""
         mfa_root = os.environ.get("MFA_ROOT_DIR", os.path.expanduser("~/Documents/MFA"))
-        print(f"[MFA] Models directory: {mfa_root}")
-        
-        for lang, models in LANGUAGE_MODELS.items():
-            print(f"[MFA] Language {lang}: acoustic={models['acoustic']}, dict={models['dictionary']}")
+        print(f"[MFA] Models directory: {mfa_root}, languages: {', '.join(self.available_languages)}")
     
     def get_model_name(self, language: str) -> str:
         """Возвращает имя acoustic модели для языка"""
-        return LANGUAGE_MODELS.get(language, {}).get("acoustic", "unknown")
+        return _MODELS_BY_LANG.get(language, ("unknown",))[0]
+    
+    def get_model_version(self, language: str) -> str:
+        """Версия MFA + acoustic модель + словарь (для ключа кэша)"""
+        return ":".join((MFA_VERSION, *_MODELS_BY_LANG.get(language, ("unknown",))))
     
     def align(
         self,
-        audio_path: str,
+        audio_bytes: bytes,
         transcript: str,
         language: str = "en",
-        input_sample_rate: int = 24000
+        input_sample_rate: int = 24000,
+        use_cache: bool = True
     ) -> Dict:
         """
         Выполняет forced alignment.
         
         Args:
-            audio_path: Путь к WAV файлу
+            audio_bytes: Содержимое аудио файла (WAV)
             transcript: Текст для alignment
             language: Код языка (en, ru, es, de, pt)
             input_sample_rate: Sample rate входного аудио
-            
+            use_cache: False — не читать кэш, запустить MFA заново (результат всё равно сохраняется)
+        
         Returns:
             Dict с ключами:
-            - words: List of {word, start, end}
+            - words: WordTiming (метки + start/end массивами; to_dicts() — список {word, start, end})
             - timing: Dict с breakdown тайминга (resample_ms, alignment_ms, parse_ms, total_ms)
+            - audio: 16kHz mono int16 сэмплы (те же, что получил MFA) для RMS refinement
+            - cached: True если результат взят из кэша
         """
-        if language not in LANGUAGE_MODELS:
-            raise ValueError(f"Unsupported language: {language}")
-        
-        models = LANGUAGE_MODELS[language]
+        try:
+            acoustic_model, dictionary = _MODELS_BY_LANG[language]
+        except KeyError:
+            raise ValueError(f"Unsupported language: {language}") from None
         
         total_start = time.time()
         timing = {}
         
-        with tempfile.TemporaryDirectory() as tmpdir:
+        # --- Кэш: повторный запрос не запускает resample и MFA ---
+        cache_key = self._cache.make_key(
+            audio_bytes, transcript, language, input_sample_rate, self.get_model_version(language)
+        )
+        cached = self._cache.get(cache_key) if use_cache else None
+        if cached:
+            cached_wav, cached_textgrid = cached
+            
+            t0 = time.time()
+            words = self._parse_textgrid(cached_textgrid)
+            timing["parse_ms"] = int((time.time() - t0) * 1000)
+            audio, _ = sf.read(cached_wav, dtype="int16", always_2d=False)
+            timing["total_ms"] = int((time.time() - total_start) * 1000)
+            
+            print(f"[MFA] Cache hit {cache_key}: {timing['total_ms']}ms")
+            
+            return {
+                "words": words,
+                "timing": timing,
+                "audio": audio,
+                "cached": True
+            }
+        
+        with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as tmpdir:
             # Подготовка файлов (align_one работает с файлами напрямую)
             audio_resampled = os.path.join(tmpdir, "audio.wav")
             transcript_path = os.path.join(tmpdir, "audio.txt")
             output_textgrid = os.path.join(tmpdir, "audio.TextGrid")
             
-            # --- Resample аудио до 16kHz 16-bit через ffmpeg ---
+            # --- Resample аудио до 16kHz 16-bit ---
             t0 = time.time()
-            self._resample_audio_ffmpeg(audio_path, audio_resampled, input_sample_rate)
+            audio = self._resample_audio(audio_bytes, audio_resampled, input_sample_rate)
             timing["resample_ms"] = int((time.time() - t0) * 1000)
             print(f"[MFA] Resample took {timing['resample_ms']}ms")
             
@@ -123,8 +194,8 @@ class MFAAligner:
                 audio_path=audio_resampled,
                 transcript_path=transcript_path,
                 output_path=output_textgrid,
-                acoustic_model=models["acoustic"],
-                dictionary=models["dictionary"]
+                acoustic_model=acoustic_model,
+                dictionary=dictionary
             )
             timing["alignment_ms"] = int((time.time() - t0) * 1000)
             print(f"[MFA] Alignment took {timing['alignment_ms']}ms")
@@ -137,6 +208,8 @@ class MFAAligner:
             words = self._parse_textgrid(output_textgrid)
             timing["parse_ms"] = int((time.time() - t0) * 1000)
             
+            self._cache.put(cache_key, audio_resampled, output_textgrid)
+            
             timing["total_ms"] = int((time.time() - total_start) * 1000)
             
             print(f"[MFA] Total processing: {timing['total_ms']}ms "
@@ -146,18 +219,64 @@ class MFAAligner:
             
             return {
                 "words": words,
-                "timing": timing
+                "timing": timing,
+                "audio": audio,
+                "cached": False
             }
     
-    def _resample_audio_ffmpeg(self, input_path: str, output_path: str, input_sr: int):
+    def _resample_audio(self, audio_bytes: bytes, output_path: str, input_sr: int) -> np.ndarray:
+        """
+        Resample аудио до 16kHz 16-bit in-process через soxr.
+        Без fork/exec ffmpeg — на коротких клипах это основная часть времени.
+        16kHz mono 16-bit WAV копируется без изменений.
+        Форматы, которые не читает libsndfile, уходят в ffmpeg.
+        
+        Returns:
+            16kHz mono int16 сэмплы (то же, что записано в output_path)
+        """
+        try:
+            with sf.SoundFile(io.BytesIO(audio_bytes)) as f:
+                if (f.format, f.subtype, f.channels, f.samplerate) == ("WAV", "PCM_16", 1, MFA_SAMPLE_RATE):
+                    # Уже то, что нужно MFA: без resample и перекодирования, байты как есть
+                    y16 = f.read(dtype="int16")
+                    with open(output_path, "wb") as out:
+                        out.write(audio_bytes)
+                    print(f"[MFA] Input is {MFA_SAMPLE_RATE}Hz mono 16-bit WAV, resample skipped")
+                    return y16
+                
+                y = f.read(dtype="float32", always_2d=True)
+                sr = f.samplerate
+        except sf.LibsndfileError:
+            self._resample_audio_ffmpeg(audio_bytes, output_path, input_sr)
+            y16, _ = sf.read(output_path, dtype="int16", always_2d=False)
+            return y16
+        
+        # Mono
+        y = y.mean(axis=1) if y.shape[1] > 1 else y[:, 0]
+        
+        if sr != MFA_SAMPLE_RATE:
+            y = soxr.resample(y, sr, MFA_SAMPLE_RATE, quality="HQ")
+        
+        y16 = np.clip(np.rint(y * 32768), -32768, 32767).astype(np.int16)
+        sf.write(output_path, y16, MFA_SAMPLE_RATE, subtype="PCM_16")
+        
+        print(f"[MFA] Resampled {sr}Hz -> {MFA_SAMPLE_RATE}Hz 16-bit via soxr")
+        return y16
+    
+    def _resample_audio_ffmpeg(self, audio_bytes: bytes, output_path: str, input_sr: int):
         """
         Resample аудио до 16kHz 16-bit через ffmpeg.
         Значительно быстрее чем librosa для этой задачи.
+        Входные байты подаются в stdin — без промежуточного файла.
         """
         cmd = [
             "ffmpeg",
+            "-nostdin",              # Без интерактива на stdin
+            "-hide_banner",          # Без баннера
+            "-loglevel", "error",    # В stderr только ошибки
+            "-threads", "1",         # Один поток: параллелизм даёт пул запросов
             "-y",                    # Перезаписывать выход
-            "-i", input_path,        # Вход
+            "-i", "pipe:0",          # Вход из stdin
             "-ar", str(MFA_SAMPLE_RATE),  # Sample rate 16kHz
             "-ac", "1",              # Mono
             "-sample_fmt", "s16",    # 16-bit
@@ -167,14 +286,16 @@ class MFAAligner:
         
         result = subprocess.run(
             cmd,
-            capture_output=True,
-            text=True,
+            input=audio_bytes,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
             timeout=60
         )
         
         if result.returncode != 0:
-            print(f"[MFA] ffmpeg STDERR: {result.stderr}")
-            raise RuntimeError(f"ffmpeg resample failed: {result.stderr}")
+            stderr = result.stderr.decode("utf-8", errors="replace")
+            print(f"[MFA] ffmpeg STDERR: {stderr}")
+            raise RuntimeError(f"ffmpeg resample failed: {stderr}")
         
         print(f"[MFA] Resampled to {MFA_SAMPLE_RATE}Hz 16-bit via ffmpeg")
     
@@ -187,59 +308,50 @@ class MFAAligner:
         dictionary: str
     ):
         """
-        Запускает MFA CLI с командой align_one.
+        Запускает MFA align_one на воркере из пула.
         
         Оптимизации:
         - align_one: пропускает corpus setup
-        - --uses_speaker_adaptation false: для TTS не нужен
-        - --no_textgrid_cleanup: экономим время на постобработке
-        - --beam 100: увеличен с дефолтного 10 для стабильности
+        - модели и словарь загружены в воркере заранее, на запрос — только выравнивание
+        - beam 100: увеличен с дефолтного 10 для стабильности
         """
-        cmd = [
-            "mfa", "align_one",
-            audio_path,
-            transcript_path,
-            dictionary,
-            acoustic_model,
-            output_path,
-            "--uses_speaker_adaptation", "false",
-            "--no_textgrid_cleanup",
-            "--beam", "100"
-        ]
+        job = {
+            "sound_file": audio_path,
+            "text_file": transcript_path,
+            "dictionary": dictionary,
+            "acoustic_model": acoustic_model,
+            "output": output_path,
+            "beam": 100
+        }
         
-        print(f"[MFA] Running: {' '.join(cmd)}")
+        print(f"[MFA] Running align_one: {audio_path} ({acoustic_model}, {dictionary})")
         
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=300  # 5 минут максимум
-        )
-        
-        if result.returncode != 0:
-            print(f"[MFA] STDERR: {result.stderr}")
-            print(f"[MFA] STDOUT: {result.stdout}")
-            raise RuntimeError(f"MFA failed: {result.stderr}")
+        # 5 минут максимум
+        self._pool.submit(job, timeout=300).result()
         
         print(f"[MFA] Alignment complete")
     
-    def _parse_textgrid(self, textgrid_path: str) -> List[Dict]:
-        """Парсит TextGrid файл и извлекает word timestamps"""
-        tg = textgrid.TextGrid.fromFile(textgrid_path)
-        
-        words = []
+    def _parse_textgrid(self, textgrid_path: str) -> WordTiming:
+        """Парсит TextGrid файл и извлекает word timestamps (только tier "words")"""
+        with open(textgrid_path, "r", encoding="utf-8") as f:
+            content = f.read()
         
         # Ищем tier с словами (обычно называется "words")
-        for tier in tg:
-            if tier.name.lower() == "words":
-                for interval in tier:
-                    if interval.mark and interval.mark.strip():
-                        words.append({
-                            "word": interval.mark.strip(),
-                            "start": round(interval.minTime, 4),
-                            "end": round(interval.maxTime, 4)
-                        })
-                break
+        tier = _WORDS_RE.search(content)
+        intervals = [
+            (xmin, xmax, text.replace('""', '"').strip())
+            for xmin, xmax, text in (_IVAL_RE.findall(tier.group(0)) if tier else [])
+        ]
+        intervals = [ival for ival in intervals if ival[2]]
+        
+        # Колонки: метки + start/end массивами, округление одним проходом
+        labels = [ival[2] for ival in intervals]
+        starts = np.fromiter((float(ival[0]) for ival in intervals), dtype=np.float64, count=len(intervals))
+        ends = np.fromiter((float(ival[1]) for ival in intervals), dtype=np.float64, count=len(intervals))
+        np.round(starts, 4, out=starts)
+        np.round(ends, 4, out=ends)
+        
+        words = WordTiming(labels=labels, starts=starts, ends=ends)
         
         print(f"[MFA] Extracted {len(words)} words from TextGrid")
         return words
@@ -0,0 +1,127 @@
+"""
+Alignment Cache - дисковый LRU кэш результатов MFA
+
+TTS пайплайн часто присылает одно и то же аудио повторно (ретраи, регрессии, батчи).
+Кэшируем 16kHz WAV + TextGrid по ключу (sha256(audio), transcript, language,
+input sample rate, версия MFA/моделей) — на попадании resample и MFA пропускаются целиком.
+
+Вытеснение: по mtime (обновляется через os.utime на каждом попадании),
+пока суммарный размер не станет меньше лимита.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+from typing import Optional, Tuple
+
+
+# На Cloud Run /tmp живёт в памяти инстанса — лимит держим умеренным
+CACHE_DIR = os.environ.get("MFA_CACHE_DIR", "/tmp/mfa-cache")
+CACHE_MAX_BYTES = int(os.environ.get("MFA_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+
+class AlignmentCache:
+    """
+    LRU кэш на диске: {key}.wav + {key}.TextGrid.
+    
+    max_bytes <= 0 отключает кэш.
+    """
+    
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = 0
+        
+        if self.enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._size = sum(
+                entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file()
+            )
+            print(f"[CACHE] {cache_dir}: {self._size / 1e6:.1f}MB / {max_bytes / 1e6:.0f}MB")
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+    
+    @staticmethod
+    def make_key(
+        audio_bytes: bytes,
+        transcript: str,
+        language: str,
+        input_sample_rate: int,
+        model_version: str
+    ) -> str:
+        """
+        Ключ кэша: хэш аудио + хэш параметров alignment'а.
+        
+        model_version входит в ключ — после обновления MFA или моделей
+        старые записи просто перестают находиться и вытесняются по LRU.
+        """
+        audio_hash = hashlib.sha256(audio_bytes).hexdigest()[:16]
+        params = f"{language}\0{input_sample_rate}\0{model_version}\0{transcript}"
+        params_hash = hashlib.sha256(params.encode("utf-8")).hexdigest()[:8]
+        return f"{audio_hash}_{params_hash}"
+    
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.cache_dir, key)
+        return base + ".wav", base + ".TextGrid"
+    
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """Возвращает (wav_path, textgrid_path) или None"""
+        if not self.enabled:
+            return None
+        
+        wav_path, textgrid_path = self._paths(key)
+        try:
+            # Обновляем mtime — запись становится самой свежей для LRU
+            os.utime(textgrid_path)
+            os.utime(wav_path)
+        except FileNotFoundError:
+            return None
+        
+        return wav_path, textgrid_path
+    
+    def put(self, key: str, wav_path: str, textgrid_path: str):
+        """Копирует результат alignment в кэш и вытесняет старые записи"""
+        if not self.enabled:
+            return
+        
+        added = 0
+        for src, dst in zip((wav_path, textgrid_path), self._paths(key)):
+            # Пишем во временный файл и атомарно переименовываем,
+            # чтобы параллельный get() не увидел недописанный файл
+            tmp = f"{dst}.{threading.get_ident()}.tmp"
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+            added += os.path.getsize(dst)
+        
+        with self._lock:
+            self._size += added
+            if self._size > self.max_bytes:
+                self._evict()
+    
+    def _evict(self):
+        """Удаляет самые старые записи, пока размер не уложится в лимит"""
+        entries = {}
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            key = os.path.splitext(entry.name)[0]
+            stat = entry.stat()
+            mtime, size = entries.get(key, (0.0, 0))
+            entries[key] = (max(mtime, stat.st_mtime), size + stat.st_size)
+        
+        self._size = sum(size for _, size in entries.values())
+        
+        for key, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if self._size <= self.max_bytes:
+                break
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._size -= size
+            print(f"[CACHE] Evicted {key}")
@@ -5,17 +5,18 @@ MFA Service - FastAPI endpoint for Montreal Forced Aligner
 Точность: ±10-20ms (с RMS refinement ±5-10ms)
 """
 
-import os
-import tempfile
+import asyncio
 import base64
 import time
-from typing import Optional, List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional, List, Dict, Union
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form
 from pydantic import BaseModel, Field
 
-from aligner import MFAAligner
+from aligner import MFAAligner, MFA_SAMPLE_RATE, MFA_WORKERS
 from rms_refiner import refine_word_endpoints
 
 
@@ -39,8 +40,8 @@ class WordTimestamp(BaseModel):
 
 class TimingBreakdown(BaseModel):
     """Детальный breakdown тайминга каждого этапа"""
-    decode_ms: int = Field(default=0, description="Base64 decode time")
-    resample_ms: int = Field(default=0, description="ffmpeg resample time")
+    decode_ms: int = Field(default=0, description="Base64 decode / upload read time")
+    resample_ms: int = Field(default=0, description="Resample time (soxr, ffmpeg fallback)")
     alignment_ms: int = Field(default=0, description="MFA align_one time (core)")
     parse_ms: int = Field(default=0, description="TextGrid parse time")
     refinement_ms: int = Field(default=0, description="RMS endpoint refinement time")
@@ -55,6 +56,7 @@ class AlignResponse(BaseModel):
     timing: TimingBreakdown
     model_used: str
     refined: bool
+    cached: bool = Field(default=False, description="Result served from alignment cache")
 
 
 class HealthResponse(BaseModel):
@@ -68,15 +70,27 @@ class HealthResponse(BaseModel):
 
 aligner: Optional[MFAAligner] = None
 
+# MFA воркеров по числу CPU; сверх этого держим не больше такой же очереди,
+# чтобы параллельные запросы не забивали tmpfs и память
+MAX_IN_FLIGHT = 2 * MFA_WORKERS
+align_semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+# Синхронная часть запроса (decode, resample, refinement) выполняется здесь,
+# а не в event loop. Потоков достаточно: MFA сам работает в отдельных процессах
+executor: Optional[ThreadPoolExecutor] = None
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Загрузка моделей при старте"""
-    global aligner
+    global aligner, executor
     print("[MFA] Initializing aligner...")
     aligner = MFAAligner()
+    executor = ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT, thread_name_prefix="align")
     print(f"[MFA] Loaded models: {aligner.available_languages}")
     yield
     print("[MFA] Shutting down...")
+    executor.shutdown(wait=True)
+    aligner.close()
 
 
 app = FastAPI(
@@ -99,6 +113,100 @@ async def health_check():
     )
 
 
+def _check_language(language: str):
+    """Проверка готовности aligner'а и языка до начала обработки"""
+    if not aligner:
+        raise HTTPException(status_code=503, detail="Aligner not initialized")
+    
+    if language not in aligner.available_languages:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Language '{language}' not supported. Available: {aligner.available_languages}"
+        )
+
+
+def _align_sync(
+    audio: Union[str, bytes],
+    transcript: str,
+    language: str,
+    refine_endpoints: bool,
+    sample_rate: int,
+    timing_data: Dict,
+    total_start: float
+) -> AlignResponse:
+    """
+    Общий pipeline для /align и /align_multipart: decode + MFA alignment + RMS refinement.
+    
+    Полностью синхронный — вызывается только через executor.
+    audio: base64 строка (/align) или уже прочитанные байты (/align_multipart)
+    """
+    # --- Decode audio ---
+    if isinstance(audio, str):
+        t0 = time.time()
+        audio_bytes = base64.b64decode(audio)
+        timing_data["decode_ms"] = int((time.time() - t0) * 1000)
+    else:
+        audio_bytes = audio
+    
+    # --- Run alignment (returns dict with words + timing) ---
+    result = aligner.align(
+        audio_bytes=audio_bytes,
+        transcript=transcript,
+        language=language,
+        input_sample_rate=sample_rate
+    )
+    
+    words = result["words"]
+    aligner_timing = result["timing"]
+    
+    # Копируем timing из aligner
+    timing_data["resample_ms"] = aligner_timing.get("resample_ms", 0)
+    timing_data["alignment_ms"] = aligner_timing.get("alignment_ms", 0)
+    timing_data["parse_ms"] = aligner_timing.get("parse_ms", 0)
+    
+    # --- RMS refinement (на 16kHz сэмплах, уже подготовленных для MFA) ---
+    timing_data["refinement_ms"] = 0
+    if refine_endpoints and len(words):
+        t0 = time.time()
+        words = refine_word_endpoints(
+            audio=result["audio"],
+            words=words,
+            sample_rate=MFA_SAMPLE_RATE
+        )
+        timing_data["refinement_ms"] = int((time.time() - t0) * 1000)
+    
+    # Calculate total duration
+    total_duration = float(words.ends[-1]) if len(words) else 0.0
+    
+    timing_data["total_ms"] = int((time.time() - total_start) * 1000)
+    
+    print(f"[MFA] === TIMING BREAKDOWN ===")
+    print(f"[MFA]   decode:     {timing_data['decode_ms']}ms")
+    print(f"[MFA]   resample:   {timing_data['resample_ms']}ms")
+    print(f"[MFA]   alignment:  {timing_data['alignment_ms']}ms")
+    print(f"[MFA]   parse:      {timing_data['parse_ms']}ms")
+    print(f"[MFA]   refinement: {timing_data['refinement_ms']}ms")
+    print(f"[MFA]   TOTAL:      {timing_data['total_ms']}ms")
+    
+    return AlignResponse(
+        words=[WordTimestamp(**w) for w in words.to_dicts()],
+        total_duration=total_duration,
+        processing_time_ms=timing_data["total_ms"],
+        timing=TimingBreakdown(**timing_data),
+        model_used=aligner.get_model_name(language),
+        refined=refine_endpoints,
+        cached=result["cached"]
+    )
+
+
+async def _run_alignment(**kwargs) -> AlignResponse:
+    """Запускает _align_sync в executor, не больше MAX_IN_FLIGHT одновременно"""
+    async with align_semaphore:
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, partial(_align_sync, **kwargs)
+        )
+
+
 @app.post("/align", response_model=AlignResponse)
 async def align_audio(request: AlignRequest):
     """
@@ -106,81 +214,60 @@ async def align_audio(request: AlignRequest):
     
     Возвращает точные timestamps для каждого слова + детальный breakdown тайминга.
     """
-    if not aligner:
-        raise HTTPException(status_code=503, detail="Aligner not initialized")
+    _check_language(request.language)
     
-    if request.language not in aligner.available_languages:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Language '{request.language}' not supported. Available: {aligner.available_languages}"
+    total_start = time.time()
+    timing_data = {}
+    
+    try:
+        return await _run_alignment(
+            audio=request.audio_base64,
+            transcript=request.transcript,
+            language=request.language,
+            refine_endpoints=request.refine_endpoints,
+            sample_rate=request.sample_rate,
+            timing_data=timing_data,
+            total_start=total_start
         )
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Alignment failed: {str(e)}")
+
+
+@app.post("/align_multipart", response_model=AlignResponse)
+async def align_audio_multipart(
+    audio: UploadFile = File(..., description="WAV audio file"),
+    transcript: str = Form(..., description="Text transcript to align"),
+    language: str = Form(default="en", description="Language code: en, ru, es, de, pt"),
+    refine_endpoints: bool = Form(default=True, description="Apply RMS refinement to endTime"),
+    sample_rate: int = Form(default=24000, description="Input audio sample rate (will be resampled to 16kHz)")
+):
+    """
+    То же, что /align, но аудио приходит бинарным файлом (multipart/form-data).
+    
+    Без base64: payload на ~25% меньше и нет лишнего декодирования.
+    """
+    _check_language(language)
     
     total_start = time.time()
     timing_data = {}
     
     try:
-        # --- Decode audio ---
+        # --- Read audio ---
         t0 = time.time()
-        audio_bytes = base64.b64decode(request.audio_base64)
+        audio_bytes = await audio.read()
         timing_data["decode_ms"] = int((time.time() - t0) * 1000)
         
-        # Create temp files
-        with tempfile.TemporaryDirectory() as tmpdir:
-            audio_path = os.path.join(tmpdir, "input.wav")
-            
-            # Save audio
-            with open(audio_path, "wb") as f:
-                f.write(audio_bytes)
-            
-            # --- Run alignment (returns dict with words + timing) ---
-            result = aligner.align(
-                audio_path=audio_path,
-                transcript=request.transcript,
-                language=request.language,
-                input_sample_rate=request.sample_rate
-            )
-            
-            words = result["words"]
-            aligner_timing = result["timing"]
-            
-            # Копируем timing из aligner
-            timing_data["resample_ms"] = aligner_timing.get("resample_ms", 0)
-            timing_data["alignment_ms"] = aligner_timing.get("alignment_ms", 0)
-            timing_data["parse_ms"] = aligner_timing.get("parse_ms", 0)
-            
-            # --- RMS refinement ---
-            timing_data["refinement_ms"] = 0
-            if request.refine_endpoints and words:
-                t0 = time.time()
-                words = refine_word_endpoints(
-                    audio_path=audio_path,
-                    words=words,
-                    sample_rate=request.sample_rate
-                )
-                timing_data["refinement_ms"] = int((time.time() - t0) * 1000)
-            
-            # Calculate total duration
-            total_duration = words[-1]["end"] if words else 0.0
-            
-            timing_data["total_ms"] = int((time.time() - total_start) * 1000)
-            
-            print(f"[MFA] === TIMING BREAKDOWN ===")
-            print(f"[MFA]   decode:     {timing_data['decode_ms']}ms")
-            print(f"[MFA]   resample:   {timing_data['resample_ms']}ms")
-            print(f"[MFA]   alignment:  {timing_data['alignment_ms']}ms")
-            print(f"[MFA]   parse:      {timing_data['parse_ms']}ms")
-            print(f"[MFA]   refinement: {timing_data['refinement_ms']}ms")
-            print(f"[MFA]   TOTAL:      {timing_data['total_ms']}ms")
-            
-            return AlignResponse(
-                words=[WordTimestamp(**w) for w in words],
-                total_duration=total_duration,
-                processing_time_ms=timing_data["total_ms"],
-                timing=TimingBreakdown(**timing_data),
-                model_used=aligner.get_model_name(request.language),
-                refined=request.refine_endpoints
-            )
-            
+        return await _run_alignment(
+            audio=audio_bytes,
+            transcript=transcript,
+            language=language,
+            refine_endpoints=refine_endpoints,
+            sample_rate=sample_rate,
+            timing_data=timing_data,
+            total_start=total_start
+        )
+        
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Alignment failed: {str(e)}")
 
@@ -191,7 +278,7 @@ async def root():
     return {
         "service": "MFA Alignment Service",
         "version": "1.1.0",
-        "endpoints": ["/health", "/align"]
+        "endpoints": ["/health", "/align", "/align_multipart"]
     }
 
 
@@ -0,0 +1,278 @@
+"""
+MFA Worker Pool - долгоживущие процессы для `mfa align_one`
+
+Каждый воркер держит загруженные модели в памяти и выполняет задачи
+без повторного запуска CLI.
+
+Модуль намеренно без тяжёлых импортов: spawn-воркер импортирует его и сам MFA.
+Но spawn также заново выполняет модуль верхнего уровня родителя, если он запущен
+как скрипт (`python main.py`, `python test_local.py`), — в каждом воркере.
+Поэтому скрипты, создающие MFAAligner, не держат тяжёлые импорты на уровне модуля
+(test_local.py), а сервис запускается через `uvicorn main:app` — там __main__ это uvicorn.
+"""
+
+import multiprocessing
+import os
+import queue
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+
+# Количество MFA воркеров (по умолчанию — по числу CPU)
+MFA_WORKERS = int(os.environ.get("MFA_WORKERS", os.cpu_count() or 1))
+
+# Запас поверх таймаута задачи: воркер сам прерывает `mfa` по таймауту
+# и успевает ответить, прежде чем родитель убьёт его вместе с дочерним процессом
+_TIMEOUT_GRACE = 10.0
+
+
+def _cli_args(job: Dict) -> List[str]:
+    """Аргументы `mfa align_one` для задачи (запуск через CLI)"""
+    return [
+        "align_one",
+        job["sound_file"],
+        job["text_file"],
+        job["dictionary"],
+        job["acoustic_model"],
+        job["output"],
+        "--uses_speaker_adaptation", "false",
+        "--no_textgrid_cleanup",
+        "--beam", str(job["beam"])
+    ]
+
+
+def _load_language(dictionary: str, acoustic_model: str):
+    """
+    Загружает acoustic model, lexicon и tokenizer — то же, что делает `mfa align_one`
+    перед выравниванием, но один раз на воркер, а не на каждый запрос.
+    """
+    from kalpy.fstext.lexicon import LexiconCompiler
+    from montreal_forced_aligner.command_line.utils import validate_model_arg
+    from montreal_forced_aligner.data import (
+        BRACKETED_WORD, CUTOFF_WORD, LAUGHTER_WORD, OOV_WORD, Language
+    )
+    from montreal_forced_aligner.dictionary.mixins import (
+        DEFAULT_BRACKETS, DEFAULT_CLITIC_MARKERS, DEFAULT_COMPOUND_MARKERS,
+        DEFAULT_PUNCTUATION, DEFAULT_WORD_BREAK_MARKERS
+    )
+    from montreal_forced_aligner.models import AcousticModel
+    from montreal_forced_aligner.tokenization.simple import SimpleTokenizer
+    from montreal_forced_aligner.tokenization.spacy import generate_language_tokenizer
+    
+    model = AcousticModel(validate_model_arg(acoustic_model, "acoustic"))
+    params = model.parameters
+    
+    lexicon = LexiconCompiler(
+        disambiguation=False,
+        silence_probability=params["silence_probability"],
+        initial_silence_probability=params["initial_silence_probability"],
+        final_silence_correction=params["final_silence_correction"],
+        final_non_silence_correction=params["final_non_silence_correction"],
+        silence_phone=params["optional_silence_phone"],
+        oov_phone=params["oov_phone"],
+        position_dependent_phones=params["position_dependent_phones"],
+        phones=params["non_silence_phones"],
+        ignore_case=True
+    )
+    lexicon.load_pronunciations(validate_model_arg(dictionary, "dictionary"))
+    # Компилируем FST сразу, список произношений после этого не нужен
+    lexicon.fst
+    lexicon.align_fst
+    lexicon.clear()
+    
+    if model.language is Language.unknown:
+        tokenizer = SimpleTokenizer(
+            word_table=lexicon.word_table,
+            word_break_markers=DEFAULT_WORD_BREAK_MARKERS,
+            punctuation=DEFAULT_PUNCTUATION,
+            clitic_markers=DEFAULT_CLITIC_MARKERS,
+            compound_markers=DEFAULT_COMPOUND_MARKERS,
+            brackets=DEFAULT_BRACKETS,
+            laughter_word=LAUGHTER_WORD,
+            oov_word=OOV_WORD,
+            bracketed_word=BRACKETED_WORD,
+            cutoff_word=CUTOFF_WORD,
+            ignore_case=True
+        )
+    else:
+        tokenizer = generate_language_tokenizer(model.meta["language"])
+    
+    print(f"[MFA] Worker {os.getpid()} loaded {acoustic_model} / {dictionary}")
+    return model, lexicon, tokenizer
+
+
+def _align_one(job: Dict, models: Dict) -> None:
+    """
+    Выравнивает один файл на загруженных моделях (per-file часть `mfa align_one`):
+    MFCC → CMVN → align каждого utterance → TextGrid.
+    """
+    from kalpy.feat.cmvn import CmvnComputer
+    from kalpy.fstext.lexicon import HierarchicalCtm
+    from kalpy.utterance import Segment
+    from kalpy.utterance import Utterance as KalpyUtterance
+    from montreal_forced_aligner.corpus.classes import FileData
+    from montreal_forced_aligner.online.alignment import align_utterance_online
+    
+    key = (job["dictionary"], job["acoustic_model"])
+    if key not in models:
+        models[key] = _load_language(*key)
+    model, lexicon, tokenizer = models[key]
+    
+    sound_file = Path(job["sound_file"])
+    file = FileData.parse_file(sound_file.stem, sound_file, Path(job["text_file"]), "", 0)
+    
+    utterances = []
+    for utterance in file.utterances:
+        seg = Segment(sound_file, utterance.begin, utterance.end, utterance.channel)
+        utt = KalpyUtterance(seg, utterance.text)
+        utt.generate_mfccs(model.mfcc_computer)
+        utterances.append(utt)
+    cmvn = CmvnComputer().compute_cmvn_from_features([utt.mfccs for utt in utterances])
+    
+    file_ctm = HierarchicalCtm([])
+    for utt in utterances:
+        utt.apply_cmvn(cmvn)
+        ctm = align_utterance_online(
+            model, utt, lexicon,
+            tokenizer=tokenizer,
+            beam=job["beam"]
+        )
+        file_ctm.word_intervals.extend(ctm.word_intervals)
+    
+    file_ctm.export_textgrid(
+        Path(job["output"]),
+        file_duration=file.wav_info.duration,
+        output_format="long_textgrid"
+    )
+
+
+def worker_main(conn):
+    """
+    Цикл MFA воркера.
+    
+    MFA импортируется один раз на процесс, модели (acoustic model, lexicon FST,
+    tokenizer) загружаются при первой задаче для языка и дальше переиспользуются —
+    на каждую задачу выполняется только выравнивание самого файла.
+    Если пакет MFA недоступен в этом интерпретаторе — запускаем CLI как раньше.
+    Ошибка (или None) отправляется обратно в pipe, воркер при этом не падает.
+    """
+    try:
+        import warnings
+        from montreal_forced_aligner import config
+        config.load_configuration()
+        warnings.simplefilter("ignore")
+        in_process = True
+    except ImportError:
+        in_process = False
+    
+    # (dictionary, acoustic_model) -> (model, lexicon, tokenizer)
+    models = {}
+    
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            # Родитель завершился без close() — выходим молча
+            break
+        if message is None:
+            break
+        job, timeout = message
+        
+        error = None
+        if in_process:
+            try:
+                _align_one(job, models)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+        else:
+            try:
+                # При таймауте subprocess.run сам убивает `mfa`
+                result = subprocess.run(
+                    ["mfa", *_cli_args(job)], capture_output=True, text=True, timeout=timeout
+                )
+                if result.returncode != 0:
+                    error = result.stderr
+            except (OSError, subprocess.SubprocessError) as e:
+                # Например, `mfa` нет в PATH
+                error = f"{type(e).__name__}: {e}"
+        
+        conn.send(error)
+
+
+class MFAWorkerPool:
+    """
+    Пул долгоживущих MFA процессов.
+    
+    Каждый воркер получает задачи по своему pipe и выполняет их последовательно.
+    submit() возвращает concurrent.futures.Future, чтобы async код мог его await'ить.
+    """
+    
+    def __init__(self, size: int = MFA_WORKERS):
+        self._ctx = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(self._spawn())
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="mfa")
+        print(f"[MFA] Started {size} MFA worker(s)")
+    
+    def _spawn(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        proc = self._ctx.Process(target=worker_main, args=(child_conn,), daemon=True)
+        proc.start()
+        child_conn.close()
+        return proc, parent_conn
+    
+    def _respawn(self, proc, conn):
+        """Убивает воркер и запускает новый на его место"""
+        proc.kill()
+        proc.join()
+        conn.close()
+        return self._spawn()
+    
+    def run(self, job: Dict, timeout: float) -> None:
+        """Выполняет одну задачу на свободном воркере (блокирует поток)"""
+        proc, conn = self._idle.get()
+        try:
+            try:
+                conn.send((job, timeout))
+            except (BrokenPipeError, OSError):
+                # Свободный воркер уже мёртв (OOM, crash) — задача ещё не начата,
+                # повторяем один раз на новом воркере
+                proc, conn = self._respawn(proc, conn)
+                conn.send((job, timeout))
+            if not conn.poll(timeout + _TIMEOUT_GRACE):
+                raise TimeoutError(f"MFA timed out after {timeout}s")
+            error = conn.recv()
+        except BaseException:
+            # Воркер в неизвестном состоянии (таймаут/упал) — заменяем новым
+            proc, conn = self._respawn(proc, conn)
+            raise
+        finally:
+            self._idle.put((proc, conn))
+        
+        if error:
+            raise RuntimeError(f"MFA failed: {error}")
+    
+    def submit(self, job: Dict, timeout: float) -> Future:
+        return self._executor.submit(self.run, job, timeout)
+    
+    def close(self):
+        """Останавливает воркеры"""
+        self._executor.shutdown(wait=True)
+        while True:
+            try:
+                proc, conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                # Воркер уже мёртв — останавливаем остальные
+                pass
+            proc.join(timeout=5)
+            if proc.is_alive():
+                proc.kill()
+                proc.join()
+            conn.close()
@@ -8,136 +8,353 @@ MFA может давать endTime чуть раньше реального о
 Результат: endTime гарантированно НЕ раньше реального окончания слова.
 """
 
+import os
+import threading
+
 import numpy as np
-import librosa
-from typing import List, Dict
+import soundfile as sf
+import soxr
+from numba import config, njit, prange
+from typing import Dict, Tuple, Union
+
+try:
+    # Опционально: SIMD (SSE/AVX/NEON) RMS на C
+    import numpy_rms
+except ImportError:
+    numpy_rms = None
+
+from word_timing import WordTiming
+
+
+# amin из librosa.amplitude_to_db (1e-5), в шкале мощности
+_AMIN_POWER = 1e-10
+
+# Размер блока для _frame_power (укладывается в L2)
+_BLOCK_BYTES = 256 * 1024
+
+# TBB threading layer numba зависает на выходе интерпретатора, если parallel-ядро
+# запускалось не из главного потока (executor в main.py) — предпочитаем OpenMP,
+# затем workqueue (если слой не задан явно через env)
+if "NUMBA_THREADING_LAYER" not in os.environ and "NUMBA_THREADING_LAYER_PRIORITY" not in os.environ:
+    config.THREADING_LAYER_PRIORITY = ["omp", "workqueue", "tbb"]
+
+# workqueue падает при одновременном запуске parallel-ядер из нескольких потоков —
+# запускаем по одному, каждый запуск и так занимает все ядра
+_PARALLEL_LOCK = threading.Lock()
+
+
+def _frame_power(y: np.ndarray, frame_length: int, hop_length: int) -> np.ndarray:
+    """
+    Мощность (RMS^2) кадров всего сигнала за один векторный проход.
+    
+    Кадры — strided view без копирования, кадр i начинается с сэмпла i * hop_length.
+    Квадраты считаются блоками кадров, чтобы рабочий набор оставался в L2.
+    Весь проход во float32 (np.square и mean с dtype=float32) — без повышения до float64.
+    
+    С numpy-rms: SIMD RMS по неперекрывающимся блокам в hop_length сэмплов,
+    мощность кадра = среднее мощностей его frame_length / hop_length блоков.
+    """
+    if numpy_rms is not None and y.ndim == 1 and frame_length % hop_length == 0:
+        blocks = np.square(numpy_rms.rms(np.ascontiguousarray(y, dtype=np.float32), window_size=hop_length))
+        n_frames = (len(y) - frame_length) // hop_length + 1
+        block_frames = np.lib.stride_tricks.sliding_window_view(blocks, frame_length // hop_length)
+        return block_frames[:n_frames].mean(axis=1, dtype=np.float32)
+    
+    frames = np.lib.stride_tricks.sliding_window_view(y, frame_length)[::hop_length]
+    power = np.empty(len(frames), dtype=np.float32)
+    
+    # Квадраты считаем блоками по ~256KiB в один переиспользуемый буфер:
+    # кадры перекрываются, и без блоков временный массив был бы вдвое больше сигнала
+    block = max(1, _BLOCK_BYTES // (4 * frame_length))
+    squares = np.empty((min(block, len(frames)), frame_length), dtype=np.float32)
+    for i in range(0, len(frames), block):
+        n = min(block, len(frames) - i)
+        np.square(frames[i:i + n], out=squares[:n], dtype=np.float32)
+        squares[:n].mean(axis=1, dtype=np.float32, out=power[i:i + n])
+    
+    return power
+
+
+@njit(cache=True, fastmath=True)
+def _refine_single(y, start, end, frame_length, hop_length, energy_ratio, amin_power):
+    """
+    Поиск конца одного слова в окне y[start:end].
+    
+    Кадры — как librosa.feature.rms(center=True) на вырезанном окне: кадр k
+    центрирован на сэмпле start + k * hop_length, за границами окна — нули.
+    Мощность считается прямо по сэмплам окна (~100ms) — без прохода по всему сигналу.
+    
+    Тишина — кадр, мощность которого ниже energy_ratio * максимум окна
+    (amplitude_to_db(ref=np.max) с amin, в квадратичной шкале).
+    Порог локальный (от пика своего окна), поэтому общую маску тишины на весь
+    сигнал заранее не посчитать; поиск останавливается на первом тихом кадре.
+    
+    Returns:
+        Индекс кадра относительно начала окна или -1, если тишины в окне нет
+    """
+    n_frames = 1 + (end - start) // hop_length
+    half = frame_length // 2
+    power = np.empty(n_frames)
+    
+    peak = amin_power
+    for k in range(n_frames):
+        lo = start + k * hop_length - half
+        hi = min(lo + frame_length, end)
+        acc = 0.0
+        for i in range(max(lo, start), hi):
+            v = float(y[i])
+            acc += v * v
+        power[k] = acc / frame_length
+        if power[k] > peak:
+            peak = power[k]
+    
+    threshold = peak * energy_ratio
+    for k in range(n_frames):
+        if max(power[k], amin_power) < threshold:
+            return k
+    
+    return -1
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _refine_all(y, starts, ends, frame_length, hop_length, energy_ratio, amin_power, out):
+    """
+    _refine_single для всех слов параллельно (prange по словам).
+    
+    Слова независимы: каждое читает только своё окно y и пишет свой out[i].
+    Для окон короче кадра out[i] = -1.
+    """
+    for i in prange(starts.shape[0]):
+        if ends[i] - starts[i] < frame_length:
+            out[i] = -1
+        else:
+            out[i] = _refine_single(
+                y, starts[i], ends[i], frame_length, hop_length, energy_ratio, amin_power
+            )
 
 
 def refine_word_endpoints(
-    audio_path: str,
-    words: List[Dict],
-    sample_rate: int = 24000,
+    audio: Union[str, np.ndarray],
+    words: WordTiming,
+    sample_rate: int = 16000,
     search_window_ms: int = 80,
     frame_ms: int = 5,
     threshold_db: float = -40.0,
     padding_ms: int = 5
-) -> List[Dict]:
+) -> WordTiming:
     """
     Уточняет endTime каждого слова на основе RMS энергии.
     
     Алгоритм:
     1. Берём окно от (endTime - 20ms) до (endTime + search_window_ms)
-    2. Вычисляем RMS энергию в frame_ms кадрах
-    3. Находим первый кадр с RMS < threshold_db
+    2. Вычисляем мощность frame_ms кадров окна (центрированы, как в librosa.feature.rms)
+    3. Находим первый кадр, энергия которого на threshold_db ниже максимума окна
     4. Это и есть реальный конец слова
     
+    Сравнение идёт в линейной (квадратичной) шкале — log10 не считается.
+    
     Args:
-        audio_path: Путь к WAV файлу
-        words: Список слов с start/end от MFA
-        sample_rate: Sample rate аудио
+        audio: Mono сэмплы (от MFAAligner.align, без повторного чтения с диска)
+               или путь к файлу
+        words: Слова с start/end от MFA (WordTiming.from_dicts — для списка dict)
+        sample_rate: Sample rate аудио (16kHz после resample для MFA)
         search_window_ms: Окно поиска вперёд от endTime
         frame_ms: Размер кадра для RMS анализа
         threshold_db: Порог тишины в dB
         padding_ms: Дополнительный отступ после найденного конца
         
     Returns:
-        Список слов с уточнёнными endTime
+        Новый WordTiming с уточнёнными endTime (labels и starts общие с исходным)
     """
-    # Загружаем аудио
-    y, sr = librosa.load(audio_path, sr=sample_rate, mono=True)
-    duration = len(y) / sr
+    audio = _as_signal(audio, sample_rate)
     
-    frame_samples = int(frame_ms / 1000 * sr)
+    frame_samples = int(frame_ms / 1000 * sample_rate)
     hop_samples = frame_samples // 2
     
-    refined_words = []
+    if len(audio) < frame_samples or not len(words):
+        return words
     
-    for word in words:
-        original_end = word["end"]
-        
-        # Окно поиска
-        search_start = max(0, original_end - 0.020)  # -20ms
-        search_end = min(duration, original_end + search_window_ms / 1000)
-        
-        start_sample = int(search_start * sr)
-        end_sample = int(search_end * sr)
-        
-        if end_sample <= start_sample:
-            refined_words.append(word)
-            continue
-        
-        segment = y[start_sample:end_sample]
-        
-        if len(segment) < frame_samples:
-            refined_words.append(word)
-            continue
-        
-        # Вычисляем RMS
-        rms = librosa.feature.rms(
-            y=segment, 
-            frame_length=frame_samples, 
-            hop_length=hop_samples
-        )[0]
-        
-        if len(rms) == 0:
-            refined_words.append(word)
-            continue
-        
-        # Конвертируем в dB
-        rms_db = librosa.amplitude_to_db(rms, ref=np.max)
-        
-        # Ищем первый кадр ниже порога
-        silence_frames = np.where(rms_db < threshold_db)[0]
-        
-        if len(silence_frames) > 0:
-            first_silence_frame = silence_frames[0]
-            silence_sample = first_silence_frame * hop_samples
-            new_end = search_start + silence_sample / sr + padding_ms / 1000
-            
-            # Не сдвигаем раньше оригинала (только вперёд)
-            new_end = max(new_end, original_end)
-            
-            # Не выходим за границы аудио
-            new_end = min(new_end, duration)
-        else:
-            # Не нашли тишину — оставляем оригинал + небольшой padding
-            new_end = min(original_end + padding_ms / 1000, duration)
-        
-        refined_words.append({
-            "word": word["word"],
-            "start": word["start"],
-            "end": round(new_end, 4)
-        })
+    ends = words.ends
+    duration = len(audio) / sample_rate
     
-    # Статистика
-    total_shift = sum(
-        refined["end"] - original["end"] 
-        for refined, original in zip(refined_words, words)
+    # Окно поиска каждого слова в сэмплах
+    search_start = np.maximum(ends - 0.020, 0.0)  # -20ms
+    search_end = np.minimum(ends + search_window_ms / 1000, duration)
+    start_samples = (search_start * sample_rate).astype(np.int64)
+    end_samples = (search_end * sample_rate).astype(np.int64)
+    
+    # amin amplitude_to_db (1e-5) задан для float сигнала в [-1, 1] — переводим в шкалу сэмплов
+    scale = np.iinfo(audio.dtype).max + 1 if audio.dtype.kind == "i" else 1.0
+    
+    # Первый кадр окна ниже порога относительно максимума окна (-1 — не нашли)
+    silence_frames = np.empty(len(words), dtype=np.int64)
+    with _PARALLEL_LOCK:
+        _refine_all(
+            audio,
+            start_samples,
+            end_samples,
+            frame_samples,
+            hop_samples,
+            10 ** (threshold_db / 10),  # Порог в dB -> отношение энергий
+            _AMIN_POWER * float(scale) ** 2,
+            silence_frames
+        )
+    
+    new_ends = np.where(
+        silence_frames >= 0,
+        # Не сдвигаем раньше оригинала (только вперёд)
+        np.maximum(search_start + silence_frames * hop_samples / sample_rate + padding_ms / 1000, ends),
+        # Не нашли тишину — оставляем оригинал + небольшой padding
+        ends + padding_ms / 1000
     )
-    avg_shift_ms = (total_shift / len(words)) * 1000 if words else 0
+    # Не выходим за границы аудио
+    np.minimum(new_ends, duration, out=new_ends)
+    # Окно короче кадра — endTime не трогаем
+    np.copyto(new_ends, ends, where=end_samples - start_samples < frame_samples)
+    
+    np.round(new_ends, 4, out=new_ends)
+    
+    refined_words = WordTiming(labels=words.labels, starts=words.starts, ends=new_ends)
+    
+    # Статистика
+    avg_shift_ms = float((new_ends - ends).mean()) * 1000
     print(f"[RMS] Refined {len(words)} words, avg shift: +{avg_shift_ms:.1f}ms")
     
     return refined_words
 
 
-def analyze_audio_energy(audio_path: str, sample_rate: int = 24000) -> Dict:
+@njit(cache=True, fastmath=True)
+def _energy_stats(power, silence_power_ratio, amin, top_db):
+    """
+    peak_db, mean_db и число тихих кадров за один вызов, без промежуточного массива dB.
+    
+    dB относительно максимума (как amplitude_to_db с ref=max, top_db):
+    первый проход — максимум, второй — порог тишины и сумма dB.
+    
+    Returns:
+        (peak_db, mean_db, silent_frames)
+    """
+    ref = amin
+    for k in range(power.shape[0]):
+        if power[k] > ref:
+            ref = power[k]
+    
+    threshold = ref * silence_power_ratio
+    peak_db = -top_db
+    sum_db = 0.0
+    silent = 0
+    for k in range(power.shape[0]):
+        p = power[k]
+        if max(p, amin) < threshold:
+            silent += 1
+        db = 10.0 * np.log10(max(p, amin) / ref)
+        if db < -top_db:
+            db = -top_db
+        if db > peak_db:
+            peak_db = db
+        sum_db += db
+    
+    return peak_db, sum_db / power.shape[0], silent
+
+
+def _load_audio(audio_path: str, sample_rate: int) -> np.ndarray:
+    """
+    Читает аудио файл в mono float32 с нужным sample rate (как librosa.load).
+    
+    Заголовок разбирается один раз (sf.info), данные читаются libsndfile
+    сразу в float32 — корректно для 24-bit и WAV с дополнительными chunk'ами.
+    """
+    info = sf.info(audio_path)
+    with sf.SoundFile(audio_path) as f:
+        y = f.read(frames=info.frames, dtype="float32", always_2d=True)
+    
+    # Mono
+    y = y.mean(axis=1) if info.channels > 1 else y[:, 0]
+    
+    if info.samplerate != sample_rate:
+        # soxr HQ — тот же resampler, что у librosa.load по умолчанию
+        y = soxr.resample(y, info.samplerate, sample_rate, quality="HQ")
+    
+    return y
+
+
+def _as_signal(audio: Union[str, np.ndarray], sample_rate: int) -> np.ndarray:
+    """Путь к файлу -> сэмплы с sample_rate; уже декодированный сигнал — как есть"""
+    if isinstance(audio, str):
+        return _load_audio(audio, sample_rate)
+    return audio
+
+
+def analyze_audio_energy(
+    audio: Union[str, np.ndarray],
+    sample_rate: int = 24000,
+    what: Tuple[str, ...] = ("peak", "mean", "silence")
+) -> Dict:
     """
     Анализирует энергию аудио для диагностики.
     
+    Args:
+        audio: Путь к файлу или уже декодированный mono сигнал с sample_rate
+               (тот же, что идёт в refine_word_endpoints — без повторного чтения)
+        sample_rate: Sample rate сигнала
+        what: Какие метрики считать: "peak", "mean", "silence".
+              Пустой кортеж — только длительность (для файла — из заголовка, без чтения сэмплов)
+        
     Returns:
-        Статистика: peak_db, mean_db, silence_ratio
+        Статистика: duration_sec + запрошенные peak_db, mean_db, silence_ratio
     """
-    y, sr = librosa.load(audio_path, sr=sample_rate, mono=True)
+    unknown = set(what) - {"peak", "mean", "silence"}
+    if unknown:
+        raise ValueError(f"Unknown stats: {sorted(unknown)}")
+    
+    if isinstance(audio, str):
+        info = sf.info(audio)
+        duration_sec = info.frames / info.samplerate
+    else:
+        duration_sec = len(audio) / sample_rate
+    
+    stats = {"duration_sec": round(duration_sec, 3)}
+    if not what:
+        return stats
+    
+    y = _as_signal(audio, sample_rate)
     
-    rms = librosa.feature.rms(y=y, frame_length=512, hop_length=256)[0]
-    rms_db = librosa.amplitude_to_db(rms, ref=np.max)
+    # amin задан для float сигнала в [-1, 1] — для int16 переводим в шкалу сэмплов,
+    # как в refine_word_endpoints
+    scale = np.iinfo(y.dtype).max + 1 if y.dtype.kind == "i" else 1.0
     
-    silence_frames = np.sum(rms_db < -40)
-    silence_ratio = silence_frames / len(rms_db) if len(rms_db) > 0 else 0
+    # Кадры центрированы, как в librosa.feature.rms (center=True)
+    y = np.pad(y, 512 // 2)
     
-    return {
-        "peak_db": float(np.max(rms_db)),
-        "mean_db": float(np.mean(rms_db)),
-        "silence_ratio": round(silence_ratio, 3),
-        "duration_sec": round(len(y) / sr, 3)
-    }
+    # Работаем с мощностью (rms^2): порог тишины сравнивается без log10
+    power = _frame_power(y, 512, 256)
+    peak_db, mean_db, silence_frames = _energy_stats(
+        power, 10 ** (-40 / 10), _AMIN_POWER * float(scale) ** 2, 80.0
+    )
+    
+    if "peak" in what:
+        stats["peak_db"] = peak_db
+    if "mean" in what:
+        stats["mean_db"] = mean_db
+    if "silence" in what:
+        stats["silence_ratio"] = round(silence_frames / len(power), 3)
+    
+    return stats
+
+
+def _warmup():
+    """
+    Компиляция numba ядер на крошечном сигнале при импорте.
+    
+    Первый запрос не платит за JIT (с cache=True — за загрузку из кэша),
+    типы аргументов совпадают с вызовами из refine_word_endpoints и analyze_audio_energy.
+    """
+    out = np.empty(1, dtype=np.int64)
+    _refine_all(
+        np.zeros(160, dtype=np.int16), np.zeros(1, dtype=np.int64), np.full(1, 160, dtype=np.int64),
+        80, 40, 0.01, 1.0, out
+    )
+    _energy_stats(np.ones(4, dtype=np.float32), 1e-4, _AMIN_POWER, 80.0)
+
+
+_warmup()
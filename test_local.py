@@ -7,20 +7,23 @@
 3. Скачать словарь: mfa model download dictionary english_us_arpa
 4. Положить test.wav в текущую директорию
 5. Запустить: python test_local.py
+   (--no-cache — не брать результат из кэша alignment'а, запустить MFA заново)
 """
 
+import argparse
 import os
 import sys
 
 # Добавляем текущую директорию в path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from aligner import MFAAligner
-from rms_refiner import refine_word_endpoints, analyze_audio_energy
 
-
-def test_alignment():
+def test_alignment(use_cache: bool = True):
     """Тестовый alignment"""
+    # Импорты здесь, а не на уровне модуля: spawn-воркеры MFA заново выполняют
+    # этот скрипт, и aligner/rms_refiner (numpy, soxr, numba) им не нужны
+    from aligner import MFAAligner, MFA_SAMPLE_RATE
+    from rms_refiner import refine_word_endpoints, analyze_audio_energy
     
     # Тестовые данные
     audio_path = "test.wav"  # Положите ваш WAV файл сюда
@@ -31,44 +34,63 @@ def test_alignment():
         print("Please provide a test WAV file")
         return
     
+    # Alignment
+    print("\n=== MFA Alignment ===")
+    with open(audio_path, "rb") as f:
+        audio_bytes = f.read()
+    
+    # Один файл — один MFA воркер (а не по числу CPU);
+    # воркер останавливается при выходе из блока
+    with MFAAligner(workers=1) as aligner:
+        result = aligner.align(
+            audio_bytes=audio_bytes,
+            transcript=transcript,
+            language="en",
+            input_sample_rate=24000,
+            use_cache=use_cache
+        )
+    words = result["words"]
+    
+    # Один декодированный 16kHz сигнал от aligner'а — и для анализа, и для refinement
+    audio = result["audio"]
+    
     # Анализ аудио
     print("\n=== Audio Analysis ===")
-    stats = analyze_audio_energy(audio_path)
+    stats = analyze_audio_energy(audio, sample_rate=MFA_SAMPLE_RATE)
     print(f"Duration: {stats['duration_sec']}s")
     print(f"Peak: {stats['peak_db']:.1f}dB")
     print(f"Mean: {stats['mean_db']:.1f}dB")
     print(f"Silence ratio: {stats['silence_ratio']:.1%}")
     
-    # Alignment
-    print("\n=== MFA Alignment ===")
-    aligner = MFAAligner()
-    
-    words = aligner.align(
-        audio_path=audio_path,
-        transcript=transcript,
-        language="en",
-        input_sample_rate=24000
-    )
-    
     print(f"\nExtracted {len(words)} words:")
-    for w in words:
-        print(f"  {w['word']:15} {w['start']:.3f} - {w['end']:.3f}")
+    for label, start, end in zip(words.labels, words.starts.tolist(), words.ends.tolist()):
+        print(f"  {label:15} {start:.3f} - {end:.3f}")
     
-    # RMS Refinement
+    # RMS Refinement (на 16kHz сэмплах от MFA)
     print("\n=== RMS Refinement ===")
     refined = refine_word_endpoints(
-        audio_path=audio_path,
+        audio=audio,
         words=words,
-        sample_rate=24000
+        sample_rate=MFA_SAMPLE_RATE
     )
     
+    # Сдвиги endTime одним векторным вычитанием, вывод одним print
+    shifts_ms = (refined.ends - words.ends) * 1000.0
+    
     print(f"\nRefined words:")
-    for orig, ref in zip(words, refined):
-        shift_ms = (ref['end'] - orig['end']) * 1000
-        print(f"  {ref['word']:15} {ref['start']:.3f} - {ref['end']:.3f}  (+{shift_ms:.1f}ms)")
+    print("\n".join(
+        f"  {label:15} {start:.3f} - {end:.3f}  (+{shift_ms:.1f}ms)"
+        for label, start, end, shift_ms in zip(
+            refined.labels, refined.starts.tolist(), refined.ends.tolist(), shifts_ms.tolist()
+        )
+    ))
     
     print("\n=== Done ===")
 
 
 if __name__ == "__main__":
-    test_alignment()
+    parser = argparse.ArgumentParser(description="Локальный тест MFA alignment")
+    parser.add_argument("--no-cache", action="store_true", help="Не брать результат из кэша")
+    args = parser.parse_args()
+    
+    test_alignment(use_cache=not args.no_cache)
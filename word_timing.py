@@ -0,0 +1,43 @@
+"""
+Word Timing - word timestamps в виде колонок (struct of arrays)
+
+Вместо списка dict {word, start, end}: метки отдельным списком,
+start/end — float64 массивами. Парсер TextGrid строит колонки сразу,
+RMS refinement работает с ними без поштучного доступа к dict.
+"""
+
+from dataclasses import dataclass
+from typing import List, Dict
+
+import numpy as np
+
+
+@dataclass
+class WordTiming:
+    """
+    Timestamps слов: labels[i], starts[i], ends[i] — одно слово.
+    
+    float64, а не float32: значения округлены до 4 знаков и уходят в JSON как есть.
+    """
+    labels: List[str]
+    starts: np.ndarray
+    ends: np.ndarray
+    
+    def __len__(self) -> int:
+        return len(self.labels)
+    
+    @classmethod
+    def from_dicts(cls, words: List[Dict]) -> "WordTiming":
+        """Из списка {word, start, end}"""
+        return cls(
+            labels=[w["word"] for w in words],
+            starts=np.fromiter((w["start"] for w in words), dtype=np.float64, count=len(words)),
+            ends=np.fromiter((w["end"] for w in words), dtype=np.float64, count=len(words))
+        )
+    
+    def to_dicts(self) -> List[Dict]:
+        """Список {word, start, end} (формат ответа API)"""
+        return [
+            {"word": label, "start": start, "end": end}
+            for label, start, end in zip(self.labels, self.starts.tolist(), self.ends.tolist())
+        ]